@@ -4,11 +4,18 @@ import glob
 import json
 import os.path
 import sqlite3
+import sys
 from neo4j import GraphDatabase, basic_auth
 import neo4j.exceptions
 import pprint
 from bson.code import Code
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
+
+# orjson parses the JSON files considerably faster, fall back to json
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 dataDir = 'data/'
@@ -21,14 +28,30 @@ doSQLite = True
 doNeo4j = True
 doMongo = True
 
+# number of JSON documents whose relationship rows are buffered before they
+# are written to sqlite
+sqliteBatchSize = 1000
+# number of JSON documents sent to neo4j in one insert query
+neo4jBatchSize = 500
+# number of upserts sent to mongo in one bulk write
+mongoBatchSize = 1000
+
 
 def main():
     if doSQLite:
-        connection = sqlite3.connect(dbFile)
+        connection = sqlite3.connect(dbFile, isolation_level=None)
         cursor = connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.execute('PRAGMA cache_size=-200000')
+        cursor.execute('PRAGMA mmap_size=268435456')
         if loadData:
+            # the database is rebuilt from the JSON files anyway, so skip
+            # fsyncs during the bulk load
+            cursor.execute('PRAGMA synchronous=OFF')
             createSchema(cursor)
             populateSqlite(jsonDir, cursor)
+        cursor.execute('PRAGMA synchronous=NORMAL')
         querySqlite(cursor)
         connection.commit()
         connection.close()
@@ -42,6 +65,27 @@ def main():
         queryMongo()
 
 
+def loadJsonFile(jsonFile):
+    ''' Parse one JSON file '''
+
+    if orjson is not None:
+        with open(jsonFile, 'rb') as jf:
+            return orjson.loads(jf.read())
+    with open(jsonFile) as jf:
+        return json.load(jf)
+
+
+def iterJsonFiles(jsonDir):
+    ''' Yield (path, data) for each JSON file in jsonDir, in glob order.
+
+    Files are parsed lazily, so only the document being inserted is held in
+    memory.
+    '''
+
+    for jsonFile in glob.glob(os.path.join(jsonDir, '*.json')):
+        yield jsonFile, loadJsonFile(jsonFile)
+
+
 ################################################################################
 #                                                                              #
 #                          SQLite Setup/Aux Functions                          #
@@ -50,6 +94,41 @@ def main():
 
 # you don't need to do anything here
 
+# Attributes each entity table is deduplicated on (see the unique indexes in
+# createSchema); getOrCreateRow takes the values in this order
+entityFields = {
+    'image':      ('url',),
+    'label':      ('mid', 'description'),
+    'page':       ('url',),
+    'landmark':   ('mid', 'description'),
+    'location':   ('latitude', 'longitude'),
+    'web_entity': ('entity_id', 'description'),
+}
+
+# Attributes each relationship table is deduplicated on
+relationshipFields = {
+    'image_tagged_label':           ('image_id', 'label_id', 'score'),
+    'image_in_page':                ('image_id', 'page_id'),
+    'image_matches_image':          ('image_id1', 'image_id2', 'type'),
+    'image_contains_landmark':      ('image_id', 'landmark_id', 'score'),
+    'image_tagged_web_entity':      ('image_id', 'web_entity_id', 'score'),
+    'landmark_located_at_location': ('landmark_id', 'location_id'),
+}
+
+# Statements for getOrCreateRow and insertRelationships, built once instead
+# of on every call; rows are bound as tuples in the order of the fields above
+insertSql = {
+    table: 'INSERT OR IGNORE INTO {} ({}) VALUES ({})'.format(
+        table, ','.join(fields), ','.join('?' * len(fields)))
+    for table, fields in {**entityFields, **relationshipFields}.items()
+}
+selectSql = {
+    table: 'SELECT id FROM {} WHERE {}'.format(
+        table, ' AND '.join('{} = ?'.format(f) for f in fields))
+    for table, fields in entityFields.items()
+}
+
+
 def createSchema(cursor, clearDb=True):
     ''' Create necessary tables in the sqlite database '''
 
@@ -203,121 +282,185 @@ def createSchema(cursor, clearDb=True):
     '''
     cursor.execute(create_11)
 
+    # Unique indexes on the attributes each entity table is deduplicated on,
+    # so that rows can be inserted with INSERT OR IGNORE (the relationship
+    # tables are indexed after loading, see createRelationshipIndexes)
+    cursor.execute('CREATE UNIQUE INDEX idx_image ON image (url);')
+    cursor.execute(
+        'CREATE UNIQUE INDEX idx_label ON label (mid, description);')
+    cursor.execute('CREATE UNIQUE INDEX idx_page ON page (url);')
+    cursor.execute(
+        'CREATE UNIQUE INDEX idx_landmark ON landmark (mid, description);')
+    cursor.execute(
+        'CREATE UNIQUE INDEX idx_location ON location (latitude, longitude);')
+    cursor.execute('CREATE UNIQUE INDEX idx_web_entity '
+                   'ON web_entity (entity_id, description);')
+
+
+def createRelationshipIndexes(cursor):
+    ''' Deduplicate the relationship tables and create their unique indexes.
+
+    The indexes are built once after the bulk load instead of being updated
+    on every insert.  Of duplicate rows, the first one inserted is kept.
+    '''
+
+    for table, fields in relationshipFields.items():
+        cursor.execute(
+            'DELETE FROM {0} WHERE id NOT IN '
+            '(SELECT MIN(id) FROM {0} GROUP BY {1});'.format(
+                table, ', '.join(fields)))
+        cursor.execute(
+            'CREATE UNIQUE INDEX IF NOT EXISTS idx_{0} ON {0} ({1});'.format(
+                table, ', '.join(fields)))
+
+    # lets query 4 count the matches of an image by image_id2 (image_id1 is
+    # the prefix of the unique index above); query 3 scans the whole table
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_image_matches_image_id2 '
+                   'ON image_matches_image (image_id2);')
+
 
 def populateSqlite(jsonDir, cursor):
-    ''' Load Google JSON results into sqlite (schema must be created before) '''
+    ''' Load Google JSON results into sqlite (schema must be created before)
+
+    The whole load runs in a single transaction.  Relationship rows are
+    buffered per table and written with one executemany per table every
+    sqliteBatchSize documents.
+    '''
 
+    cursor.execute('BEGIN')
+    rowIds = {}
+    relationships = {}
     cnt = 0
     # Find and process all json files in the directory
-    for jsonFile in glob.glob(os.path.join(jsonDir, '*.json')):
+    for jsonFile, jsonData in iterJsonFiles(jsonDir):
         print('\n\nLoading', jsonFile, 'into sqlite')
-        with open(jsonFile) as jf:
-            jsonData = json.load(jf)
-            insertImage(cursor, jsonData)
-            cnt += 1
+        insertImage(cursor, jsonData, rowIds, relationships)
+        cnt += 1
+        if cnt % sqliteBatchSize == 0:
+            insertRelationships(cursor, relationships)
+
+    insertRelationships(cursor, relationships)
+    createRelationshipIndexes(cursor)
+    cursor.execute('COMMIT')
 
     print('\nLoaded', cnt, 'JSON documents into Sqlite\n')
 
 
-def insertImage(cursor, jsonData):
-    imageId = getOrCreateRow(cursor, 'image', 
-        {'url': jsonData['url'], 'is_document': 1})
+def insertImage(cursor, jsonData, rowIds, relationships):
+    ''' Insert the entities of one JSON document into sqlite.
+
+    rowIds caches the IDs of entity rows for getOrCreateRow.  Rows of the
+    relationship tables are not inserted right away but appended to
+    relationships, a dict of {'table': [values, ...]}, to be written by
+    insertRelationships.
+    '''
+
+    def addRelationship(table, values):
+        relationships.setdefault(table, []).append(values)
+
+    # the image may already exist as a match of a previously loaded document
+    cursor.execute(
+        'INSERT INTO image (url, is_document) VALUES (?, 1) '
+        'ON CONFLICT (url) DO UPDATE SET is_document = 1 RETURNING id',
+        (jsonData['url'],))
+    imageId = cursor.fetchone()[0]
+    rowIds['image', (jsonData['url'],)] = imageId
     print('Inserting Image With ID', imageId)
 
+    response = jsonData['response']
+    webDetection = response.get('webDetection', {})
+
     # process labelAnnotations field
-    for ann in jsonData['response']['labelAnnotations']:
-        labelId = getOrCreateRow(cursor, 'label',
-            {'mid': ann['mid'], 'description': ann['description']})
-        ltiId = getOrCreateRow(cursor, 'image_tagged_label', 
-            {'image_id': imageId, 'label_id': labelId, 'score': ann['score']})
+    for ann in response.get('labelAnnotations', ()):
+        labelId = getOrCreateRow(cursor, rowIds, 'label',
+            (ann['mid'], ann['description']))
+        addRelationship('image_tagged_label', 
+            (imageId, labelId, ann['score']))
 
     # process webDetection.fullMatchingImages field
-    if 'fullMatchingImages' in jsonData['response']['webDetection']:
-        for fmi in jsonData['response']['webDetection']['fullMatchingImages']:
-            imageId2 = getOrCreateRow(cursor, 'image', {'url': fmi['url']})
-            imiId = getOrCreateRow(cursor, 'image_matches_image', 
-                {'image_id1': imageId, 'image_id2': imageId2, 'type': 'full'})
+    for fmi in webDetection.get('fullMatchingImages', ()):
+        imageId2 = getOrCreateRow(cursor, rowIds, 'image', (fmi['url'],))
+        addRelationship('image_matches_image', (imageId, imageId2, 'full'))
     
     # process webDetection.partialMatchingImages field
-    if 'partialMatchingImages' in jsonData['response']['webDetection']:
-        for pmi in \
-        jsonData['response']['webDetection']['partialMatchingImages']:
-            imageId2 = getOrCreateRow(cursor, 'image', {'url': pmi['url']})
-            imiId = getOrCreateRow(cursor, 'image_matches_image', 
-                {'image_id1': imageId, 'image_id2': imageId2, 
-                 'type': 'partial'})
+    for pmi in webDetection.get('partialMatchingImages', ()):
+        imageId2 = getOrCreateRow(cursor, rowIds, 'image', (pmi['url'],))
+        addRelationship('image_matches_image', (imageId, imageId2, 'partial'))
     
     # process webDetection.pagesWithMatchingImages field
-    if 'pagesWithMatchingImages' in jsonData['response']['webDetection']:
-        for pmi in \
-        jsonData['response']['webDetection']['pagesWithMatchingImages']:
-            pageId = getOrCreateRow(cursor, 'page', {'url': pmi['url']})
-            iipId = getOrCreateRow(cursor, 'image_in_page', 
-                {'image_id': imageId, 'page_id': pageId})
+    for pmi in webDetection.get('pagesWithMatchingImages', ()):
+        pageId = getOrCreateRow(cursor, rowIds, 'page', (pmi['url'],))
+        addRelationship('image_in_page', (imageId, pageId))
     
     # process webDetection.webEntities field 
     # (note: some webEntities have no description field)
-    for ent in jsonData['response']['webDetection']['webEntities']:
+    for ent in webDetection.get('webEntities', ()):
         if 'description' in ent:
             desc = ent['description']
         else:
             desc = ''
         # shorter syntax: ent['description'] if 'description' in ent else ''
-        webEntityId = getOrCreateRow(cursor, 'web_entity', 
-            {'entity_id': ent['entityId'], 'description': desc})
-        iteId = getOrCreateRow(cursor, 'image_tagged_web_entity', 
-            {'image_id': imageId, 'web_entity_id': webEntityId, 
-             'score': ent['score']})
+        webEntityId = getOrCreateRow(cursor, rowIds, 'web_entity', 
+            (ent['entityId'], desc))
+        addRelationship('image_tagged_web_entity', 
+            (imageId, webEntityId, ent['score']))
     
     # process landmarkAnnotations and landmarkAnnotations.locations fields
     # (note: some landmarks have no description field)
-    if 'landmarkAnnotations' in jsonData['response']:
-        for lma in jsonData['response']['landmarkAnnotations']:
-            if 'description' in lma:
-                desc = lma['description']
-            else:
-                desc = ''
-            landmarkId = getOrCreateRow(cursor, 'landmark', 
-                {'mid': lma['mid'], 'description': desc})
-            iclId = getOrCreateRow(cursor, 'image_contains_landmark', 
-                {'image_id': imageId, 'landmark_id': landmarkId, 
-                 'score': lma['score']})
-            for loc in lma['locations']:
-                locationId = getOrCreateRow(cursor, 'location', 
-                    {'latitude': loc['latLng']['latitude'], 
-                     'longitude': loc['latLng']['longitude']})
-                lllId = getOrCreateRow(cursor, 'landmark_located_at_location', 
-                    {'landmark_id': landmarkId, 'location_id': locationId})
-
-
-def getOrCreateRow(cursor, table, dataDict):
+    for lma in response.get('landmarkAnnotations', ()):
+        if 'description' in lma:
+            desc = lma['description']
+        else:
+            desc = ''
+        landmarkId = getOrCreateRow(cursor, rowIds, 'landmark', 
+            (lma['mid'], desc))
+        addRelationship('image_contains_landmark', 
+            (imageId, landmarkId, lma['score']))
+        for loc in lma['locations']:
+            latLng = loc['latLng']
+            locationId = getOrCreateRow(cursor, rowIds, 'location', 
+                (latLng['latitude'], latLng['longitude']))
+            addRelationship('landmark_located_at_location', 
+                (landmarkId, locationId))
+
+
+def getOrCreateRow(cursor, rowIds, table, values):
     ''' Return the ID of a row of the given table with the given data.
 
     If the row does not already exists then create it first.  Existence is
-    determined by matching on all supplied values.  Table is the table name,
-    dataDict is a dict of {'attribute': value} pairs.
+    determined by the unique index on the attributes in entityFields[table],
+    values is a tuple of their values.  IDs are cached in the dict rowIds so
+    that rows seen before are found without querying sqlite.
     '''
 
-    whereClauses = ' AND '.join(['"{}" = :{}'.format(k, k) for k in dataDict])
-    select = 'SELECT id FROM {} WHERE {}'.format(table, whereClauses)
-    # print(select)
+    key = (table, values)
+    if key in rowIds:
+        return rowIds[key]
+
+    # a new row reports its ID directly, only an existing one is looked up
+    cursor.execute(insertSql[table], values)
+    if cursor.rowcount:
+        rowIds[key] = cursor.lastrowid
+        return cursor.lastrowid
 
-    cursor.execute(select, dataDict)
+    cursor.execute(selectSql[table], values)
     res = cursor.fetchone()
     if res is not None:
+        rowIds[key] = res[0]
         return res[0]
+    raise Exception('Something went wrong with ' + str(values))
 
-    fields = ','.join('"{}"'.format(k) for k in dataDict)
-    values = ','.join(':{}'.format(k) for k in dataDict)
-    insert = 'INSERT INTO {} ({}) values({})'.format(table, fields, values)
-    # print(insert)
-    cursor.execute(insert, dataDict)
 
-    cursor.execute(select, dataDict)
-    res = cursor.fetchone()
-    if res is not None:
-        return res[0]
-    raise Exception('Something went wrong with ' + str(dataDict))
+def insertRelationships(cursor, relationships):
+    ''' Write the buffered relationship rows, one executemany per table.
+
+    Duplicate rows are removed by createRelationshipIndexes after the load
+    (or skipped, if the indexes already exist).
+    '''
+
+    for table, rows in relationships.items():
+        cursor.executemany(insertSql[table], rows)
+    relationships.clear()
 
 
 def querySqliteAndPrintResults(query, cursor, title='Running query:'):
@@ -342,7 +485,8 @@ def populateNeo4j(jsonDir, clearDb=False):
     'Load the JSON results from google into neo4j'
 
     driver = GraphDatabase.driver(
-        'bolt://localhost:7687', auth=basic_auth('neo4j', 'cisc4610'))
+        'bolt://localhost:7687', auth=basic_auth('neo4j', 'cisc4610'),
+        max_connection_pool_size=50)
     session = driver.session()
 
     # From: https://stackoverflow.com/a/29715865/2037288
@@ -357,21 +501,18 @@ def populateNeo4j(jsonDir, clearDb=False):
     # TODO: complete insert query to include all necessary entities and
     # relationships at once
     insertQuery = '''
-    WITH $json as q
+    UNWIND $docs as q
     MERGE (img:Image {url:q.url})
-        ON CREATE SET img.isDocument = 'true'
-        ON MATCH  SET img.isDocument = 'true'
+    SET img:Document
     FOREACH (ann in q.response.labelAnnotations | 
         MERGE (lbl:Label {mid:ann.mid})
             ON CREATE SET lbl.description = ann.description
         MERGE (img)-[:TAGGED {score:ann.score}]->(lbl))
     FOREACH (fmi in q.response.webDetection.fullMatchingImages | 
         MERGE (img2:Image {url:fmi.url})
-            ON CREATE SET img2.isDocument = 'false'
         MERGE (img)-[:MATCH {type:'full'}]->(img2))
     FOREACH (pma in q.response.webDetection.partialMatchingImages | 
         MERGE (img2:Image {url:pma.url})
-            ON CREATE SET img2.isDocument = 'false'
         MERGE (img)-[:MATCH {type:'partial'}]->(img2))
     FOREACH (web in q.response.webDetection.webEntities | 
         MERGE (ent:WebEntity {entityId:web.entityId})
@@ -402,16 +543,48 @@ def populateNeo4j(jsonDir, clearDb=False):
         for record in result:
             print('Deleted', record['deletedNodesCount'], 'nodes')
 
+    # lets the MERGEs look up their keys in an index; Landmark and Location
+    # are merged on two properties, so they get composite indexes (node key
+    # constraints would need the enterprise edition)
+    schemaQueries = [
+        'CREATE CONSTRAINT IF NOT EXISTS FOR (i:Image) REQUIRE i.url IS UNIQUE',
+        'CREATE CONSTRAINT IF NOT EXISTS FOR (l:Label) REQUIRE l.mid IS UNIQUE',
+        'CREATE CONSTRAINT IF NOT EXISTS FOR (p:Page) REQUIRE p.url IS UNIQUE',
+        'CREATE CONSTRAINT IF NOT EXISTS '
+        'FOR (w:WebEntity) REQUIRE w.entityId IS UNIQUE',
+        'CREATE INDEX IF NOT EXISTS FOR (l:Landmark) ON (l.mid, l.description)',
+        'CREATE INDEX IF NOT EXISTS '
+        'FOR (l:Location) ON (l.latitude, l.longitude)',
+    ]
+    for schemaQuery in schemaQueries:
+        session.run(schemaQuery).consume()
+
+    def insertBatch(docs):
+        ''' Insert docs in one transaction, return how many were loaded.
+
+        If the batch fails, its documents are retried one at a time so that
+        only the offending ones are skipped.
+        '''
+        try:
+            session.execute_write(
+                lambda tx: tx.run(insertQuery, docs=docs).consume())
+            return len(docs)
+        except neo4j.exceptions.ClientError as ce:
+            if len(docs) == 1:
+                print(' ^^^^ Failed:', docs[0].get('url'), str(ce))
+                return 0
+        return sum(insertBatch([doc]) for doc in docs)
+
     loaded = 0
-    for jsonFile in glob.glob(os.path.join(jsonDir, '*.json')):
+    docs = []
+    for jsonFile, jsonData in iterJsonFiles(jsonDir):
         print('Loading', jsonFile, 'into neo4j')
-        with open(jsonFile) as jf:
-            jsonData = json.load(jf)
-            try:
-                session.run(insertQuery, {'json': jsonData})
-                loaded += 1
-            except neo4j.exceptions.ClientError as ce:
-                print(' ^^^^ Failed:', str(ce))
+        docs.append(jsonData)
+        if len(docs) == neo4jBatchSize:
+            loaded += insertBatch(docs)
+            docs = []
+    if docs:
+        loaded += insertBatch(docs)
 
     print('\nLoaded', loaded, 'JSON documents into Neo4j\n')
 
@@ -421,18 +594,20 @@ def populateNeo4j(jsonDir, clearDb=False):
 
 
 def queryNeo4jAndPrintResults(query, session, title='Running query:'):
+    records = session.run(query) if query.strip() else []
+    printNeo4jResults(query, records, title)
+
+
+def printNeo4jResults(query, records, title='Running query:'):
     print()
     print(title)
     print(query)
 
-    if not query.strip():
-        return
-    
-    for record in session.run(query):
-        print(' ' * 4, end='')
-        for val in record:
-            print(val, end='\t')
-        print()
+    # build the output first and write it at once instead of printing
+    # every value separately
+    lines = [' ' * 4 + '\t'.join(map(str, record.values())) + '\n'
+             for record in records]
+    sys.stdout.write(''.join(lines))
 
 
 ################################################################################
@@ -453,12 +628,19 @@ def populateMongo(jsonDir, clearDb=True):
     if clearDb:
         client.homework3.googleTagged.delete_many({})
 
-    for jsonFile in glob.glob(os.path.join(jsonDir, '*.json')):
+    # lets the upserts look up the url in an index
+    collection.create_index('url', unique=True)
+
+    ops = []
+    for jsonFile, jsonData in iterJsonFiles(jsonDir):
         print('Loading', jsonFile, 'into mongo')
-        with open(jsonFile) as jf:
-            jsonData = json.load(jf)
         key = {'url': jsonData['url']}
-        collection.update_one(key, {'$set': jsonData}, upsert=True);
+        ops.append(UpdateOne(key, {'$set': jsonData}, upsert=True))
+        if len(ops) == mongoBatchSize:
+            collection.bulk_write(ops, ordered=False)
+            ops = []
+    if ops:
+        collection.bulk_write(ops, ordered=False)
 
     print('Mongo now contains', collection.count_documents({}), 'documents')
 
@@ -470,8 +652,9 @@ def aggregateMongoAndPrintResults(pipeline, collection, desc='Running query:'):
     pprint.pprint(pipeline)
     print('********************** Results **********************')
     if len(pipeline) > 0:
-        for result in collection.aggregate(pipeline):
-            pprint.pprint(result)
+        lines = [json.dumps(result, default=str) + '\n'
+                 for result in collection.aggregate(pipeline)]
+        sys.stdout.write(''.join(lines))
     print('*****************************************************')
 
 
@@ -523,9 +706,15 @@ def querySqlite(cursor):
     query_3 = '''
         SELECT img.url, COUNT(*)
         FROM   image img
-        JOIN   image_matches_image imi
-        ON     img.id == imi.image_id1
-        OR     img.id == imi.image_id2
+        JOIN   (SELECT image_id1 AS image_id
+                FROM   image_matches_image
+
+                UNION ALL
+
+                SELECT image_id2
+                FROM   image_matches_image
+                WHERE  image_id1 != image_id2) imi
+        ON     img.id == imi.image_id
         GROUP BY img.id
         ORDER BY COUNT(*) DESC, img.url
         LIMIT 10;
@@ -538,137 +727,206 @@ def querySqlite(cursor):
     # followed by their URL alphabetically. List only the Image URLs and the 
     # numbers of relationships.
     query_4 = '''
-        WITH counts (image_id, cnt) AS (
-            SELECT image_id, COUNT(*)
-            FROM   image_tagged_label
-            GROUP BY image_id
-            
-            UNION ALL
-            
-            SELECT image_id, COUNT(*) 
-            FROM   image_in_page
-            GROUP BY image_id
-            
-            UNION ALL
-            
-            SELECT image_id1, COUNT(*) 
-            FROM   image_matches_image
-            GROUP BY image_id1
-            
-            UNION ALL
-            
-            SELECT image_id2, COUNT(*) 
-            FROM   image_matches_image
-            WHERE  image_id1 != image_id2
-            GROUP BY image_id2
-            
-            UNION ALL
-            
-            SELECT image_id, COUNT(*) 
-            FROM   image_contains_landmark
-            GROUP BY image_id
-            
-            UNION ALL
-            
-            SELECT image_id, COUNT(*) 
-            FROM   image_tagged_web_entity
-            GROUP BY image_id
-        )
-        SELECT image.url, SUM(counts.cnt) rel_cnt
-        FROM   image
-        JOIN   counts 
-        ON     image.id == counts.image_id
-        WHERE  image.is_document == 1
-        GROUP BY image.url
-        ORDER BY rel_cnt DESC, image.url
+        SELECT img.url,
+               (SELECT COUNT(*)
+                FROM   image_tagged_label
+                WHERE  image_id == img.id)
+             + (SELECT COUNT(*)
+                FROM   image_in_page
+                WHERE  image_id == img.id)
+             + (SELECT COUNT(*)
+                FROM   image_matches_image
+                WHERE  image_id1 == img.id)
+             + (SELECT COUNT(*)
+                FROM   image_matches_image
+                WHERE  image_id2 == img.id
+                AND    image_id1 != image_id2)
+             + (SELECT COUNT(*)
+                FROM   image_contains_landmark
+                WHERE  image_id == img.id)
+             + (SELECT COUNT(*)
+                FROM   image_tagged_web_entity
+                WHERE  image_id == img.id) rel_cnt
+        FROM   image img
+        WHERE  img.is_document == 1
+        ORDER BY rel_cnt DESC, img.url
         LIMIT 10;
     '''
     querySqliteAndPrintResults(query_4, cursor, title='SQL Query 4')
 
 
+# TODO: 5. List the 10 Images with the greatest number of Landmarks 
+# contained in them. List them in descending order of the number of 
+# Landmarks they contain, followed by their URL alphabetically. 
+# List only the Image URLs and the numbers of Landmarks.
+# (same as SQL query 1)
+query_5 = '''
+    MATCH (i:Image)-[:CONTAINS]->(lm:Landmark)
+    RETURN i.url, COUNT(lm)
+    ORDER BY COUNT(lm) DESC, i.url
+    LIMIT 10;
+'''
+
+# TODO: 6. List all Landmark descriptions associated with more than one 
+# geographic Location in the data. List them in descending order of the 
+# number of Locations, followed by the description alphabetically.
+# List only the descriptions and the numbers of Locations.
+# (same as SQL query 2)
+query_6 = '''
+    MATCH (la:Landmark) -[:LOCATED_AT]->(lo:Location)
+    WITH  la.description AS description, count(lo) AS cnt
+    WHERE cnt > 1
+    RETURN description, cnt
+    ORDER BY cnt DESC, description;
+'''
+
+# TODO: 7. List the 10 Images with the greatest number of Image matches of 
+# either type (partial or full). List them in descending order of the number
+# of matches, followed by their URL alphabetically. 
+# List only the Image URLs and the numbers of matches.
+# (same as SQL query 3)
+query_7 = '''
+    MATCH (m:Image)-[:MATCH]-(n:Image)
+    RETURN m.url, COUNT(n)
+    ORDER BY COUNT(n) DESC, m.url
+    LIMIT 10;
+'''
+
+# TODO: 8. List the 10 documents (Images for which there is a JSON file) 
+# with the largest number of relationships of any kind (with Labels, Pages, 
+# etc.). List them in descending order of the number of relationships, 
+# followed by their URL alphabetically. List only the Image URLs and the 
+# numbers of relationships.
+# (same as SQL query 4)
+query_8 = '''
+    MATCH (i:Document)-[r]-()
+    RETURN i.url, COUNT(r)
+    ORDER BY COUNT(r) DESC, i.url
+    LIMIT 10;
+'''
+
+# TODO: 9. List all "Landmark" nodes associated with more than one 
+# geographic Location in the data. List them in descending order of the 
+# number of Locations, followed by their description alphabetically.
+# List only the description and the number of locations.
+# (slightly different from SQL query 2 and Neo4j query 2)
+# TODO: In a comment below, briefly explain why this query returns fewer 
+# results than the one above. What about the data causes this?
+query_9 = '''
+    MATCH (la:Landmark) -[:LOCATED_AT]->(lo:Location)
+    WITH  la, COUNT(lo) AS cnt
+    WHERE cnt > 1
+    RETURN la.description, cnt
+    ORDER BY cnt DESC, la.description;
+'''
+# the landmark descriptions "Statue of Liberty" and "New York City" each 
+# appear in the data with two different mid's and two different locations;
+# this causes two nodes to be created for each of these descriptions; 
+# individually, these nodes only have one location each, but when grouped by
+# description, they have two; that's why they are included in the results of
+# query 6 but not those of query 9
+
+neo4jQueries = (('Neo4j Query 1', query_5),
+                ('Neo4j Query 2', query_6),
+                ('Neo4j Query 3', query_7),
+                ('Neo4j Query 4', query_8),
+                ('Neo4j Query 5', query_9))
+
+
 def queryNeo4j():
     driver = GraphDatabase.driver(
-        'bolt://localhost:7687', auth=basic_auth('neo4j', 'cisc4610'))
+        'bolt://localhost:7687', auth=basic_auth('neo4j', 'cisc4610'),
+        max_connection_pool_size=50)
     session = driver.session()
 
-    # TODO: 5. List the 10 Images with the greatest number of Landmarks 
-    # contained in them. List them in descending order of the number of 
-    # Landmarks they contain, followed by their URL alphabetically. 
-    # List only the Image URLs and the numbers of Landmarks.
-    # (same as SQL query 1)
-    query_5 = '''
-        MATCH (i:Image)-[:CONTAINS]->(lm:Landmark)
-        RETURN i.url, COUNT(lm)
-        ORDER BY COUNT(lm) DESC, i.url
-        LIMIT 10;
-    '''
-    queryNeo4jAndPrintResults(query_5, session, title='Neo4j Query 1')
-
-    # TODO: 6. List all Landmark descriptions associated with more than one 
-    # geographic Location in the data. List them in descending order of the 
-    # number of Locations, followed by the description alphabetically.
-    # List only the descriptions and the numbers of Locations.
-    # (same as SQL query 2)
-    query_6 = '''
-        MATCH (la:Landmark) -[:LOCATED_AT]->(lo:Location)
-        WITH  la.description AS description, count(lo) AS cnt
-        WHERE cnt > 1
-        RETURN description, cnt
-        ORDER BY cnt DESC, description;
-    '''
-    queryNeo4jAndPrintResults(query_6, session, title='Neo4j Query 2')
-
-    # TODO: 7. List the 10 Images with the greatest number of Image matches of 
-    # either type (partial or full). List them in descending order of the number
-    # of matches, followed by their URL alphabetically. 
-    # List only the Image URLs and the numbers of matches.
-    # (same as SQL query 3)
-    query_7 = '''
-        MATCH (m:Image)-[:MATCH]-(n:Image)
-        RETURN m.url, COUNT(n)
-        ORDER BY COUNT(n) DESC, m.url
-        LIMIT 10;
-    '''
-    queryNeo4jAndPrintResults(query_7, session, title='Neo4j Query 3')
+    # run all queries in one managed read transaction, print afterwards in
+    # case the transaction function is retried
+    results = session.execute_read(
+        lambda tx: [list(tx.run(query)) if query.strip() else []
+                    for _, query in neo4jQueries])
+    for (title, query), records in zip(neo4jQueries, results):
+        printNeo4jResults(query, records, title)
 
-    # TODO: 8. List the 10 documents (Images for which there is a JSON file) 
-    # with the largest number of relationships of any kind (with Labels, Pages, 
-    # etc.). List them in descending order of the number of relationships, 
-    # followed by their URL alphabetically. List only the Image URLs and the 
-    # numbers of relationships.
-    # (same as SQL query 4)
-    query_8 = '''
-        MATCH (i:Image {isDocument:'true'})-[r]-()
-        RETURN i.url, COUNT(r)
-        ORDER BY COUNT(r) DESC, i.url
-        LIMIT 10;
-    '''
-    queryNeo4jAndPrintResults(query_8, session, title='Neo4j Query 4')
-    
-    # TODO: 9. List all "Landmark" nodes associated with more than one 
-    # geographic Location in the data. List them in descending order of the 
-    # number of Locations, followed by their description alphabetically.
-    # List only the description and the number of locations.
-    # (slightly different from SQL query 2 and Neo4j query 2)
-    # TODO: In a comment below, briefly explain why this query returns fewer 
-    # results than the one above. What about the data causes this?
-    query_9 = '''
-        MATCH (la:Landmark) -[:LOCATED_AT]->(lo:Location)
-        WITH  la, COUNT(lo) AS cnt
-        WHERE cnt > 1
-        RETURN la.description, cnt
-        ORDER BY cnt DESC, la.description;
-    '''
-    # the landmark descriptions "Statue of Liberty" and "New York City" each 
-    # appear in the data with two different mid's and two different locations;
-    # this causes two nodes to be created for each of these descriptions; 
-    # individually, these nodes only have one location each, but when grouped by
-    # description, they have two; that's why they are included in the results of
-    # query 6 but not those of query 9
-    queryNeo4jAndPrintResults(query_9, session, title='Neo4j Query 5')
+    session.close()
 
 
-    session.close()
+# TODO: 10. List the 10 Images with the greatest number of Landmarks 
+# contained in them. List them in descending order of the number of 
+# Landmarks they contain, followed by their URL alphabetically. 
+# List only the Image URLs and the numbers of Landmarks.
+# (same as SQL query 1 and Neo4j query 1)
+pipeline_1 = [
+    {'$project': {'cnt': {'$size': {'$ifNull': [
+                                        '$response.landmarkAnnotations',
+                                        []]}},
+                  'url': 1,
+                  '_id': 0}},
+    {'$sort': {'cnt': -1, 'url': 1}},
+    {'$limit': 10}
+]
+
+# TODO: 11. List all Landmark descriptions associated with more than one 
+# geographic Location in the data. List them in descending order of the 
+# number of Locations, followed by the description alphabetically.
+# List only the descriptions and the numbers of Locations.
+# (same as SQL query 2 and Neo4j query 2)
+pipeline_2 = [
+    {'$unwind': {'path': '$response.landmarkAnnotations'}},
+    {'$unwind': {'path': '$response.landmarkAnnotations.locations'}},
+    {'$group': {'_id': {'landmark': 
+                            '$response.landmarkAnnotations.description',
+                        'location': 
+                            '$response.landmarkAnnotations.locations.latLng'
+                       }}},
+    {'$group': {'_id': '$_id.landmark', 'cnt': {'$sum': 1}}},
+    {'$sort': {'cnt': -1, '_id': 1}},
+    {'$match': {'$expr': {'$gt': ['$cnt', 1]}}}
+]
+
+# TODO: 12. List the 10 Images with the greatest number of Landmarks 
+# contained in them. List them in descending order of the number of 
+# Landmarks they contain, followed by their URL alphabetically. 
+# List only the Image URLs and the numbers of Landmarks.
+# (same as SQL query 3 and Neo4j query 3)
+pipeline_3 = [
+    {'$set': {'allMatches': {'$concatArrays': [
+        {'$ifNull': ['$response.webDetection.partialMatchingImages', []]},
+        {'$ifNull': ['$response.webDetection.fullMatchingImages', []]}
+        ]}}},
+    {'$addFields': {'matchCount': {'$size': '$allMatches'}}},
+    {'$sort': {'matchCount': -1, 'url': 1}},
+    {'$limit': 10},
+    {'$project': {'_id': 0, 'matchCount': '$matchCount', 'url': '$url'}}
+]
+
+# TODO: 13. List the 10 documents (Images for which there is a JSON file) 
+# with the largest number of relationships of any kind (with Labels, Pages, 
+# etc.). List them in descending order of the number of relationships, 
+# followed by their URL alphabetically. List only the Image URLs and the 
+# numbers of relationships.
+# (same as SQL query 4 and Neo4j query 4)
+pipeline_4 = [
+    {'$project': {'_id': 0,
+                  'cnt': {'$add': [
+        {'$size': {'$ifNull': ['$response.labelAnnotations', []]}},
+        {'$size': {'$ifNull': ['$response.landmarkAnnotations', []]}},
+        {'$size': {'$ifNull': 
+            ['$response.webDetection.pagesWithMatchingImages', []]}},
+        {'$size': {'$ifNull': 
+            ['$response.webDetection.webEntities', []]}},
+        {'$size': {'$ifNull': 
+            ['$response.webDetection.partialMatchingImages', []]}},
+        {'$size': {'$ifNull': 
+            ['$response.webDetection.fullMatchingImages', []]}}]},
+                  'url': 1}},
+    {'$sort': {'cnt': -1, 'url': 1}},
+    {'$limit': 10}
+]
+
+mongoPipelines = (('MongoDB pipeline 1', pipeline_1),
+                  ('MongoDB pipeline 2', pipeline_2),
+                  ('MongoDB pipeline 3', pipeline_3),
+                  ('MongoDB pipeline 4', pipeline_4))
 
 
 def queryMongo():
@@ -676,90 +934,8 @@ def queryMongo():
     db = client.homework3
     collection = db.googleTagged
 
-    # TODO: 10. List the 10 Images with the greatest number of Landmarks 
-    # contained in them. List them in descending order of the number of 
-    # Landmarks they contain, followed by their URL alphabetically. 
-    # List only the Image URLs and the numbers of Landmarks.
-    # (same as SQL query 1 and Neo4j query 1)
-    pipeline_1 = [
-        {'$project': {'cnt': {'$size': {'$ifNull': [
-                                            '$response.landmarkAnnotations',
-                                            []]}},
-                      'url': 1,
-                      '_id': 0}},
-        {'$sort': {'cnt': -1, 'url': 1}},
-        {'$limit': 10}
-    ]
-    aggregateMongoAndPrintResults(pipeline_1, collection, 'MongoDB pipeline 1')
-
-    # TODO: 11. List all Landmark descriptions associated with more than one 
-    # geographic Location in the data. List them in descending order of the 
-    # number of Locations, followed by the description alphabetically.
-    # List only the descriptions and the numbers of Locations.
-    # (same as SQL query 2 and Neo4j query 2)
-    pipeline_2 = [
-        {'$unwind': {'path': '$response.landmarkAnnotations'}},
-        {'$unwind': {'path': '$response.landmarkAnnotations.locations'}},
-        {'$group': {'_id': {'landmark': 
-                                '$response.landmarkAnnotations.description',
-                            'location': 
-                                '$response.landmarkAnnotations.locations.latLng'
-                           }}},
-        {'$group': {'_id': '$_id.landmark', 'cnt': {'$sum': 1}}},
-        {'$sort': {'cnt': -1, '_id': 1}},
-        {'$match': {'$expr': {'$gt': ['$cnt', 1]}}}
-    ]
-    aggregateMongoAndPrintResults(pipeline_2, collection, 'MongoDB pipeline 2')
-
-    # TODO: 12. List the 10 Images with the greatest number of Landmarks 
-    # contained in them. List them in descending order of the number of 
-    # Landmarks they contain, followed by their URL alphabetically. 
-    # List only the Image URLs and the numbers of Landmarks.
-    # (same as SQL query 3 and Neo4j query 3)
-    pipeline_3 = [
-        {'$set': {'allMatches': {'$concatArrays': [
-            {'$ifNull': ['$response.webDetection.partialMatchingImages', []]},
-            {'$ifNull': ['$response.webDetection.fullMatchingImages', []]}
-            ]}}},
-        {'$addFields': {'matchCount': {'$size': '$allMatches'}}},
-        {'$sort': {'matchCount': -1, 'url': 1}},
-        {'$limit': 10},
-        {'$project': {'_id': 0, 'matchCount': '$matchCount', 'url': '$url'}}
-    ]
-    aggregateMongoAndPrintResults(pipeline_3, collection, 'MongoDB pipeline 3')
-
-    # TODO: 13. List the 10 documents (Images for which there is a JSON file) 
-    # with the largest number of relationships of any kind (with Labels, Pages, 
-    # etc.). List them in descending order of the number of relationships, 
-    # followed by their URL alphabetically. List only the Image URLs and the 
-    # numbers of relationships.
-    # (same as SQL query 4 and Neo4j query 4)
-    pipeline_4 = [
-        {'$set': {
-            'cnt_entities': {'$size': {'$ifNull': 
-                ['$response.webDetection.webEntities', []]}},
-            'cnt_full_matches': {'$size': {'$ifNull': 
-                ['$response.webDetection.fullMatchingImages', []]}},
-            'cnt_labels': {'$size': {'$ifNull': 
-                ['$response.labelAnnotations', []]}},
-            'cnt_landmarks': {'$size': {'$ifNull': 
-                ['$response.landmarkAnnotations', []]}},
-            'cnt_pages': {'$size': {'$ifNull': 
-                ['$response.webDetection.pagesWithMatchingImages', []]}},
-            'cnt_partial_matches': {'$size': {'$ifNull': 
-                ['$response.webDetection.partialMatchingImages', []]}}}},
-        {'$project': {'_id': 0,
-                      'cnt': {'$sum': ['$cnt_labels',
-                                       '$cnt_landmarks',
-                                       '$cnt_pages',
-                                       '$cnt_entities',
-                                       '$cnt_partial_matches',
-                                       '$cnt_full_matches']},
-                      'url': 1}},
-        {'$sort': {'cnt': -1, 'url': 1}},
-        {'$limit': 10}
-    ]
-    aggregateMongoAndPrintResults(pipeline_4, collection, 'MongoDB pipeline 4')
+    for desc, pipeline in mongoPipelines:
+        aggregateMongoAndPrintResults(pipeline, collection, desc)
 
 
 if __name__ == '__main__':